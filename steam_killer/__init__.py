@@ -3,24 +3,36 @@
 """SteamKiller: Daemon that terminates Steam on Linux when certain conditions are met."""
 
 import os
+import re
+import argparse
 import subprocess
-import datetime
+import signal
+import select
 import logging
 import asyncio
+import time
 from pathlib import Path
-from dateutil.relativedelta import relativedelta
-import psutil
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from inotify_simple import INotify, flags
+from jeepney import DBusAddress, DBusErrorResponse, new_method_call
+from jeepney.wrappers import unwrap_msg
+from jeepney.io.blocking import open_dbus_connection
 
 STEAM_DIR = os.path.expanduser("~/.steam")
 STEAM_PIDFILE = Path(STEAM_DIR, "steam.pid").resolve()
-ALLOWED_PERIOD = {
-    "weekday": 5,
-    "hour_start": 6,
-    "hour_end": 18,
-}  # Monday is 0 and Sunday is 6
+_STEAM_PIDFILE_STR = str(STEAM_PIDFILE)
+ALLOWED_WEEKDAY = 5  # Monday is 0 and Sunday is 6
+ALLOWED_HOUR_START = 6
+ALLOWED_HOUR_END = 18  # inclusive
 PROC_TERM_TIMEOUT = 10  # waiting duration seconds, sends SIGKILL after
+DEBOUNCE_DELAY = 0.2  # seconds, coalesces the burst of events of a single write
+MONITOR_MIN_INTERVAL = 1.0  # seconds, skips repeated checks of the same PID
+POLL_INTERVAL = 30  # seconds between PID file checks where inotify is unavailable
+NETWORK_FS_TYPES = {"nfs", "nfs4", "cifs", "smbfs", "smb3"}  # no inotify support
+NOTIFICATIONS = DBusAddress(
+    "/org/freedesktop/Notifications",
+    bus_name="org.freedesktop.Notifications",
+    interface="org.freedesktop.Notifications",
+)
 
 
 def check_steam() -> None:
@@ -28,7 +40,7 @@ def check_steam() -> None:
     if os.path.isdir(STEAM_DIR):
         logging.debug("Steam directory found.")
 
-        if os.path.isfile(STEAM_PIDFILE):
+        if os.path.isfile(_STEAM_PIDFILE_STR):
             logging.debug("Steam PID file found.")
             return True
         else:
@@ -39,70 +51,107 @@ def check_steam() -> None:
     return False
 
 
-def check_time(weekday, hour_start, hour_end) -> bool:
-    """Check if time based conditions are met"""
-    now = datetime.datetime.now()
-
-    if now.weekday() == weekday:
-        is_allowed_day = True
-    else:
-        is_allowed_day = False
+def _proc_comm(pid: int) -> str | None:
+    """Read the command name of the process with given PID"""
+    try:
+        fd = os.open(f"/proc/{pid}/comm", os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        return os.read(fd, 64).decode(errors="replace").rstrip("\n")
+    except ProcessLookupError:
+        return None
+    finally:
+        os.close(fd)
 
-    if (now.hour >= hour_start) and (now.hour <= hour_end):
-        is_allowed_time = True
-    else:
-        is_allowed_time = False
 
-    if (is_allowed_day is True) and (is_allowed_time is True):
-        return True
-    else:
-        return False
+def check_proc(pid: int, name: str):
+    """Check if the process with given PID has a matching name"""
+    if _proc_comm(pid) == name:
+        return pid
+    return None
 
 
-def check_proc(pid: int, name: str):
-    """Check all processes for a matching name"""
-    if psutil.pid_exists(pid):
-        proc = psutil.Process(pid)
-        if proc.name() == name:
-            return proc
+_last_run = (0, 0.0)  # PID and monotonic time of the last check
 
 
-def monitor() -> None:
+def monitor(
+    _localtime=time.localtime,
+    _monotonic=time.monotonic,
+    _wd=ALLOWED_WEEKDAY,
+    _hs=ALLOWED_HOUR_START,
+    _he=ALLOWED_HOUR_END,
+) -> None:
     """Check conditions and act"""
-    if not check_time(**ALLOWED_PERIOD):
-        pid = read_pidfile()
-        proc = check_proc(pid, "steam")
-        if proc:
-            terminate_proc(proc)
+    global _last_run
+    # defaults bind the time conditions as locals, this runs on every PID file event
+    now = _localtime()
+    if not (now.tm_wday == _wd and _hs <= now.tm_hour <= _he):
+        try:
+            pid = read_pidfile()
+        except (OSError, ValueError) as err:
+            # e.g. removed or caught mid-write by the poller, the next write triggers again
+            logging.debug("Failed to read Steam PID file: %s", err)
+            return
+        # e.g. the startup check directly followed by a PID file event
+        t = _monotonic()
+        last_pid, last_t = _last_run
+        if pid == last_pid and t - last_t < MONITOR_MIN_INTERVAL:
+            return
+        _last_run = (pid, t)
+
+        if check_proc(pid, "steam"):
+            terminate_proc(pid, "steam")
 
 
 def read_pidfile() -> int:
     """Read Steam PID file and return the PID"""
-    with open(STEAM_PIDFILE, "r") as file:
-        pid = int(file.read())
-        return pid
+    fd = os.open(_STEAM_PIDFILE_STR, os.O_RDONLY)
+    try:
+        return int(os.read(fd, 32))
+    finally:
+        os.close(fd)
 
 
-class SteamEventHandler(FileSystemEventHandler):
-    """Handle file system events on Steam PID file"""
+_dbus_conn = None
 
-    def on_modified(self, event):
-        if event.src_path == str(STEAM_PIDFILE):
-            monitor()
 
-    def on_created(self, event):
-        if event.src_path == str(STEAM_PIDFILE):
-            monitor()
+def notify_dbus(summary: str, body: str, icon: str) -> None:
+    """Send notification over a persistent D-Bus session bus connection"""
+    global _dbus_conn
+    if _dbus_conn is None:
+        _dbus_conn = open_dbus_connection(bus="SESSION")
+
+    msg = new_method_call(
+        NOTIFICATIONS,
+        "Notify",
+        "susssasa{sv}i",
+        ("Steam Killer", 0, icon, summary, body, [], {}, -1),
+    )
+    unwrap_msg(_dbus_conn.send_and_get_reply(msg, timeout=1))
 
 
 def notify_desktop() -> None:
     """Send notification to Desktop Environment"""
+    global _dbus_conn
     summary = "Steam Killer"
     body = "Terminating Steam."
-    cmd_list = ["notify-send", summary, body]
 
     icon = "/usr/share/icons/hicolor/256x256/apps/steam.png"
-    if os.path.isfile(icon):
+    if not os.path.isfile(icon):
+        icon = ""
+
+    try:
+        notify_dbus(summary, body, icon)
+        return
+    except (OSError, KeyError, RuntimeError, ValueError, DBusErrorResponse):
+        logging.debug("Failed to notify over D-Bus, falling back to notify-send.")
+        if _dbus_conn is not None:
+            _dbus_conn.close()
+            _dbus_conn = None
+
+    cmd_list = ["notify-send", summary, body]
+    if icon:
         cmd_list.append("--icon")
         cmd_list.append(icon)
 
@@ -112,59 +161,174 @@ def notify_desktop() -> None:
         logging.warning("Failed to send desktop notification.")
 
 
-def terminate_proc(proc) -> None:
+def terminate_proc(pid: int, name: str) -> None:
     """Terminate program, kill if needed"""
-    notify_desktop()
+    try:
+        pidfd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return
 
     try:
-        logging.info(f"SIGTERM {proc}")
-        proc.terminate()
-        proc.wait(PROC_TERM_TIMEOUT)
-    except psutil.TimeoutExpired:
-        logging.warning(f"SIGKILL {proc}")
-        proc.kill()
-    else:
-        logging.info(f"process {proc} terminated.")
+        # the pidfd refers to this very process, so check it wasn't replaced meanwhile
+        if not check_proc(pid, name):
+            return
+        notify_desktop()
+        logging.info("SIGTERM %s", pid)
+        signal.pidfd_send_signal(pidfd, signal.SIGTERM)
+
+        # pidfd becomes readable when the process exits
+        ready, _, _ = select.select([pidfd], [], [], PROC_TERM_TIMEOUT)
+        if not ready:
+            logging.warning("SIGKILL %s", pid)
+            signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+            return
+    except ProcessLookupError:
+        pass
+    finally:
+        os.close(pidfd)
+    logging.info("process %s terminated.", pid)
 
 
 def calc_time_to_end():
     """Calculate time in seconds between now and the next end of allowed period."""
-    ap=ALLOWED_PERIOD
-    now = datetime.datetime.now()
-    # relativedelta +1 a day so we have to -1 otherwise 0 ends up as Tuesday
-    end = now + relativedelta(weekday=(ap["weekday"] - 1), hour=ap["hour_end"])
-    delta = (end - now).total_seconds()
-    return delta
+    now = time.time()
+    tm = time.localtime(now)
+    days_ahead = (ALLOWED_WEEKDAY - tm.tm_wday) % 7
+    # the period ends at the start of the hour after ALLOWED_HOUR_END
+    if days_ahead == 0 and tm.tm_hour > ALLOWED_HOUR_END:
+        days_ahead = 7
+    # mktime normalizes the day overflow and takes care of DST
+    end = time.mktime(
+        (tm.tm_year, tm.tm_mon, tm.tm_mday + days_ahead, ALLOWED_HOUR_END + 1, 0, 0, 0, 0, -1)
+    )
+    return end - now
 
 def sched_monitor(loop):
     """Monitor when called and schedule a new call at the end of the allowed period."""
     # check first, in case steam was opened before the daemon was started
-    monitor()
-    delay = calc_time_to_end()
-    loop.call_later(delay, sched_monitor, loop)
+    try:
+        monitor()
+    finally:
+        delay = calc_time_to_end()
+        loop.call_later(delay, sched_monitor, loop)
+
+def get_fs_type(path) -> str | None:
+    """Return the type of the filesystem mounted at the deepest parent of path"""
+    path = os.path.realpath(path)
+    fs_type, mount_len = None, -1
+    with open("/proc/mounts", "r") as file:
+        for line in file:
+            _, mount_point, mount_type, _ = line.split(" ", 3)
+            # spaces and other special characters are octal escaped
+            mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m[1], 8)), mount_point)
+            if len(mount_point) > mount_len and (
+                path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+            ):
+                fs_type, mount_len = mount_type, len(mount_point)
+    return fs_type
+
+
+def inotify_pidfile(loop):
+    """Run monitor whenever Steam PID file is written."""
+    inot = INotify()
+    try:
+        # only a completed write or a rename into place matters, steam touches many other files
+        inot.add_watch(STEAM_PIDFILE.parent, flags.CLOSE_WRITE | flags.MOVED_TO)
+    except OSError:
+        inot.close()
+        raise
+    pidfile_name = STEAM_PIDFILE.name
+    debounced = None
+
+    def _drain_inotify():
+        nonlocal debounced
+        if any(event.name == pidfile_name for event in inot.read(timeout=0)):
+            # steam writes the file in a burst, only act once it settles
+            if debounced is not None:
+                debounced.cancel()
+            debounced = loop.call_later(DEBOUNCE_DELAY, monitor)
+
+    loop.add_reader(inot.fileno(), _drain_inotify)
+    return inot
+
+
+def poll_pidfile(loop, interval=POLL_INTERVAL):
+    """Run monitor whenever Steam PID file changed since the last poll."""
+
+    def _stat():
+        try:
+            stat = os.stat(_STEAM_PIDFILE_STR)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    last = _stat()
+
+    def _poll():
+        nonlocal last
+        loop.call_later(interval, _poll)
+        current = _stat()
+        if current != last:
+            last = current
+            if current is not None:
+                monitor()
+
+    loop.call_later(interval, _poll)
+
+
+def watch_pidfile(loop):
+    """Watch Steam PID file with inotify, or poll it where that is not supported."""
+    fs_type = get_fs_type(STEAM_PIDFILE.parent)
+    if fs_type not in NETWORK_FS_TYPES:
+        try:
+            inotify_pidfile(loop)
+            return
+        except OSError as err:
+            logging.warning("Failed to watch Steam PID file with inotify: %s", err)
+    else:
+        logging.info("Steam directory is on %s, inotify is not supported.", fs_type)
+
+    logging.info("Polling Steam PID file every %s seconds.", POLL_INTERVAL)
+    poll_pidfile(loop)
+
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="check conditions once and exit instead of running as a daemon",
+    )
+    args = parser.parse_args()
+
+    level_name = (os.environ.get("STEAM_KILLER_LOGLEVEL") or "INFO").upper()
+    level = logging.getLevelName(level_name)  # not an int for unknown names
     logging.basicConfig(
         format="[%(levelname)s] %(message)s",
-        level=logging.DEBUG,
+        level=level if isinstance(level, int) else logging.INFO,
         handlers=[logging.StreamHandler()],
     )
     logger = logging.getLogger()
-    logger.info("Initializing daemon.")
+    if not isinstance(level, int):
+        logger.warning("Unknown log level %s, using INFO.", level_name)
 
     if not check_steam():
         logging.info("Exiting.")
         exit()
 
+    if args.check:
+        monitor()
+        return
+
+    logger.info("Initializing daemon.")
+
     # close at the end of next allowed period
     loop = asyncio.new_event_loop()
     sched_monitor(loop)
 
     # trigger whenever steam is opened
-    pidfile_observer = Observer()
-    pidfile_observer.schedule(SteamEventHandler(), STEAM_PIDFILE, recursive=False)
-    pidfile_observer.start()
-    pidfile_observer.join()
+    watch_pidfile(loop)
+    loop.run_forever()
 
 if __name__ == "__main__":
     main()